@@ -0,0 +1,83 @@
+"""Escaping throughput of a listing against the per-line loop it replaced.
+
+Builds a large synthetic C file wrapped the way pygmentize wraps it and
+escapes it with the chained str.replace per line loop that process_file
+used to run over every source line, with MINTED_ESCAPES over the whole
+file in one pass (ignoring strings) and the way
+process_file escapes now: SourceFile.get_linked_code on the tokenized
+file, which only touches the lines holding an @ and skips their strings.
+
+    python benchmarks/escape.py --lines 200000 --ats 50
+"""
+from pathlib import Path
+import timeit
+import sys
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from pdfcode import MINTED_ESCAPES, SourceFile, get_language, tokenize
+
+def create_code(num_lines, at_every):
+    lines = []
+    for i in range(num_lines):
+        if i % at_every == 0:
+            lines.append('    fn("a@b"); /* @param some_var_{} */'.format(i))
+        elif i % 10 == 0:
+            lines.append('    /* see some_var_{} and $x */'.format(i))
+        else:
+            lines.append('    int some_var_{} = other_fn(a_b, "c\\\\d");'
+                         .format(i))
+
+    code = '\\begin{{minted}}[escapeinside=@@, linenos]{{c}}\n    {}\n' \
+        '\n    \\end{{minted}}\n            '.format('\n'.join(lines))
+
+    return code.split('\n')
+
+def escape_per_line(code):
+    code = list(code)
+    for i in range(1, len(code) - 2):
+        code[i] = code[i].replace('\\', '\\\\')
+        code[i] = code[i].replace('_', '@\\_@')
+        code[i] = code[i].replace('$', '\\$')
+
+    return code
+
+def escape_whole(code):
+    body = MINTED_ESCAPES.escape('\n'.join(code[1:len(code) - 2]))
+    return [code[0]] + body.split('\n') + code[len(code) - 2:]
+
+def tokenize_source(code, language):
+    # NOTE no link lines, as with files that have no tags
+    identifiers, spans = tokenize(language, code, set())
+    return SourceFile('bench.c', 1, language, code, identifiers,
+                      spans)
+
+@click.command()
+@click.option('--lines', default=200000, help='Source lines in the file.')
+@click.option('--ats', default=50, help='One @ comment every N lines.')
+@click.option('--repeat', default=5, help='Runs per case, best kept.')
+def main(lines, ats, repeat):
+    code = create_code(lines, ats)
+    language = get_language('bench.c')
+    size = sum(len(line) for line in code) / 1e6
+
+    # the @ inside of the strings is the only difference
+    source = tokenize_source(code, language)
+    assert source.get_linked_code() == [
+        line.replace('"a@\\PYGZat{}@b"', '"a@b"')
+        for line in escape_whole(code)]
+
+    click.echo('{} lines, {:.1f} MB, one @ comment every {} lines'
+               .format(lines, size, ats))
+    for name, escape in (
+            ('per line loop (before)', lambda: escape_per_line(code)),
+            ('MINTED_ESCAPES, whole file', lambda: escape_whole(code)),
+            ('tokenize (done for links anyway)',
+             lambda: tokenize_source(code, language)),
+            ('get_linked_code', source.get_linked_code)):
+        best = min(timeit.repeat(escape, number=1, repeat=repeat))
+        click.echo('{:34} {:8.3f}s {:8.1f} MB/s'
+                   .format(name, best, size / best))
+
+if __name__ == '__main__':
+    main()
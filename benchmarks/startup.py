@@ -0,0 +1,113 @@
+"""Time to first output for a one file listing against a large database.
+
+Builds a synthetic source tree and its GNU Global sqlite database
+(GPATH, GTAGS, GRTAGS), then times a full listing, a focused
+`--include` listing of a single file and `--shard` runs, which look up
+their pages lazily like `--include` but over many files.
+
+    python benchmarks/startup.py --files 4000 --tags 40
+    python benchmarks/startup.py --files 4000 --no-key-index
+"""
+from pathlib import Path
+import sqlite3 as sq3
+import subprocess
+import tempfile
+import time
+import sys
+import click
+
+PDFCODE = Path(__file__).resolve().parent.parent / 'pdfcode.py'
+
+SOURCE = '''#include <stdio.h>
+
+int tag0_0(int a) {{ return a; }}
+
+int main(void) {{
+{}
+    return 0;
+}}
+'''
+
+def create_db(path, rows, key_index=True):
+    db = sq3.connect(str(path))
+    # NOTE same layout as the GNU Global sqlite3 dbop
+    if key_index:
+        db.execute('create table db (key text, dat text, extra text, '
+                   'primary key(key, dat))')
+    else:
+        db.execute('create table db (key text, dat text, extra text)')
+    db.executemany('insert into db values (?, ?, ?)', rows)
+    db.commit()
+    db.close()
+
+def create_tree(root, num_files, tags_per_file, key_index=True):
+    called = ['tag{}_{}'.format(f, t)
+              for f in range(1, num_files, 97)
+              for t in range(0, tags_per_file, 7)]
+    (root / 'main.c').write_text(SOURCE.format(
+        '\n'.join('    {}(0);'.format(name) for name in called)))
+
+    paths = [('main.c', '1')] + [('src/f{}.c'.format(f), str(f + 1))
+                                 for f in range(1, num_files)]
+    (root / 'src').mkdir()
+    for f in range(1, num_files):
+        (root / 'src' / 'f{}.c'.format(f)).write_text(
+            '/* f{} */\n\n'.format(f) +
+            ''.join('int tag{}_{}(int a);\n'.format(f, t)
+                    for t in range(tags_per_file)) +
+            '\n' * 6)
+    create_db(root / 'GPATH',
+              [(name, num, None) for name, num in paths] +
+              [(num, name, None) for name, num in paths])
+
+    # main.c defines tag0_0 on line 3 and calls from line 6 on
+    defs = [('tag0_0', '1 tag0_0 3 int tag0_0(int a) {', '1')]
+    refs = [(name, '1 {} {}'.format(name, i + 6), '1')
+            for i, name in enumerate(called)]
+    for f in range(1, num_files):
+        for t in range(tags_per_file):
+            name = 'tag{}_{}'.format(f, t)
+            defs.append((name, '{} {} {} int {}(int a);'.format(
+                f + 1, name, t + 3, name), str(f + 1)))
+            refs.append((name, '{} {} {},2-3'.format(
+                f % (num_files - 1) + 2, name, t + 3),
+                str(f % (num_files - 1) + 2)))
+    create_db(root / 'GTAGS', defs, key_index)
+    create_db(root / 'GRTAGS', refs, key_index)
+
+def time_run(root, args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, str(PDFCODE)] + args, cwd=str(root),
+                   check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+@click.command()
+@click.option('--files', default=5000, help='Files in the database.')
+@click.option('--tags', default=40, help='Definitions per file.')
+@click.option('--repeat', default=3, help='Runs per listing, best kept.')
+@click.option('--key-index/--no-key-index', default=True,
+              help='Index GTAGS and GRTAGS on key like GNU Global.')
+def main(files, tags, repeat, key_index):
+    with tempfile.TemporaryDirectory() as root:
+        root = Path(root)
+        create_tree(root, files, tags, key_index)
+        click.echo('{} files, {} definitions and reference entries each'
+                   .format(files, files * tags))
+
+        shard = ['--checkpoint-dir', 'shard']
+        for name, args in (('full listing', []),
+                           ('one file, --include', ['--include', 'main.c']),
+                           ('all files, --shard 1/1',
+                            ['--shard', '1/1'] + shard),
+                           ('quarter, --shard 1/4',
+                            ['--shard', '1/4'] + shard),
+                           ('full listing --use-rev', ['--use-rev', 'True']),
+                           ('one file, --include --use-rev',
+                            ['--include', 'main.c', '--use-rev', 'True']),
+                           ('all files, --shard 1/1 --use-rev',
+                            ['--shard', '1/1', '--use-rev', 'True'] + shard)):
+            best = min(time_run(root, args) for _ in range(repeat))
+            click.echo('{:34} {:8.3f}s'.format(name, best))
+
+if __name__ == '__main__':
+    main()
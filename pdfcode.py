@@ -1,8 +1,14 @@
-from dataclasses import dataclass
-from typing import Optional, List
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Tuple
 from pathlib import Path
+from bisect import bisect_right
+from itertools import accumulate
+import re
 import sqlite3 as sq3
 import codecs
+import hashlib
+import json
+import os
 import click
 
 def src_get_line_link(file_num, line_num):
@@ -123,11 +129,7 @@ class DefPage:
                                       definition.line_num)
             code = inline_pygmentize(
                 definition.file_name,
-                code_snippet_fix_brackets(
-                    definition.code,
-                    (('{', '@$\\lbrace$@'),
-                     ('}', '@$\\rbrace$@'))
-                )
+                MINTINLINE_ESCAPES.escape(definition.code)
             )
             line = (
                 '\\verb|{}|\\hyperlink{{{}}}{{$^D$}}'.format(
@@ -171,67 +173,243 @@ class Gtags:
         self.grtags_db.text_factory = \
             lambda x: codecs.decode(x, errors='backslashreplace')
 
+        self.files = None
+        self.file_names = None
+
     def get_files(self):
+        if self.files is not None:
+            return self.files
+
         c = self.gpath_db.cursor()
         c.execute('select * from db')
         files = c.fetchall()
 
-        files = [(f['key'], int(f['dat']))
-                    for f in files if f['dat'].isnumeric()]
+        self.files = [(f['key'], int(f['dat']))
+                      for f in files if f['dat'].isnumeric()]
+
+        return self.files
+
+    def get_file_names(self):
+        # file number to name
+        if self.file_names is None:
+            self.file_names = dict([reversed(f)
+                                    for f in self.get_files()])
 
-        return files
+        return self.file_names
+
+# NOTE chunked to stay under the sqlite variable limit
+SQL_CHUNK = 500
+
+def select_tags(db, tagnames=None):
+    c = db.cursor()
+    if tagnames is None:
+        c.execute('select * from db')
+    else:
+        tagnames = list(tagnames)
+        c.execute('select * from db where key in ({})'
+                  .format(', '.join('?' * len(tagnames))), tagnames)
+
+    return c
+
+def has_key_index(db):
+    c = db.cursor()
+    c.execute('pragma index_list(db)')
+    for index in c.fetchall():
+        c.execute('pragma index_info("{}")'.format(index['name']))
+        columns = c.fetchall()
+        if columns and columns[0]['name'] == 'key':
+            return True
+
+    return False
+
+def select_file_tags(db, file_nums):
+    file_nums = [str(file_num) for file_num in file_nums]
+    tags = []
+    c = db.cursor()
+    for i in range(0, len(file_nums), SQL_CHUNK):
+        chunk = file_nums[i:i + SQL_CHUNK]
+        c.execute('select * from db where extra in ({})'
+                  .format(', '.join('?' * len(chunk))), chunk)
+        tags += c.fetchall()
+
+    return tags
+
+class LazyPages:
+    """Def or rev pages built on first lookup."""
+
+    def __init__(self, gtags, get_pages):
+        self.gtags = gtags
+        self.get_pages = get_pages
+        self.pages = dict()
+
+    def load(self, tagnames):
+        # NOTE one query per chunk of tags instead of one per tag
+        tagnames = sorted(tagname for tagname in set(tagnames)
+                          if tagname not in self.pages)
+        for i in range(0, len(tagnames), SQL_CHUNK):
+            chunk = tagnames[i:i + SQL_CHUNK]
+            pages = self.get_pages(self.gtags, chunk)
+            for tagname in chunk:
+                self.pages[tagname] = pages.get(tagname)
+
+    def get(self, tagname):
+        if tagname not in self.pages:
+            self.load([tagname])
+
+        return self.pages[tagname]
+
+    def values(self):
+        # NOTE only the pages looked up so far
+        return [page for page in self.pages.values() if page is not None]
 
 # TODO type out pages - dict of key: tag_name, val: link page
 def process_file(gtags: Gtags, file, def_pages, rev_pages, full_lines, use_rev=False):
+    language = get_language(file[0])
     code = pygmentize(file[0])
 
     # unrecognized extension
-    if code is None:
+    if language is None or code is None:
         return None, None
 
-    code = \
-        process_reverse_links(gtags, file, code, def_pages)
+    file_num = file[1]
+    target_lines = set(full_lines.get(file_num, ()))
+
+    # NOTE tokenised once, the tokens are shared by link placement
+    # and escaping
+    identifiers, spans = tokenize(language, code, target_lines)
+    source = SourceFile(file[0], file[1], language, code,
+                        identifiers, spans)
+
+    process_reverse_links(gtags, source, def_pages)
 
     if use_rev:
-        code = \
-            process_definitions(gtags, file, code, rev_pages)
+        process_definitions(gtags, source, rev_pages)
 
-    file_num = file[1]
-    # NOTE -1 to avoid including \end{minted} line
-    for i in range(1, len(code) - 1):
-        # NOTE fix to pygments issue with latex in comments
-        if full_lines.get(file_num) and i not in full_lines[file_num]:
-            # NOTE fix to pygments issue with comments and underscores
-            # hack as not guaranteed to be a comment
-            code[i] = code[i].replace('\\', '\\\\')
-            # hack as not guaranteed to be a comment
-            code[i] = code[i].replace('_', '@\\_@')
-            # hack as not guaranteed to be a comment
-            code[i] = code[i].replace('$', '\$')
-            continue
-        elif full_lines.get(file_num) is None:
-            # hack as not guaranteed to be a comment
-            code[i] = code[i].replace('\\', '\\\\')
-            # hack as not guaranteed to be a comment
-            code[i] = code[i].replace('_', '@\\_@')
-            # hack as not guaranteed to be a comment
-            code[i] = code[i].replace('$', '\$')
-            continue
+    # NOTE links are added and the source escaped in one pass
+    code = source.get_linked_code()
 
-        # NOTE not from 0 to avoid including \begin{minted} line
+    # NOTE not from 0 to avoid including \begin{minted} line
+    for i in get_target_lines(code, target_lines):
         code[i] = '@\\hypertarget{{{}}}{{}}@'.format(
             src_get_line_link(file_num, i)) + code[i]
 
     # name and code
     return file[0], code
 
-KNOWN_EXTS = {
-    '.c': 'c',
-    '.h': 'c',
-    '.hpp': 'c++',
-    '.cpp': 'c++',
-    '.py': 'python',
-}
+def get_target_lines(code, full_lines):
+    # NOTE first and last two lines are the minted wrapper
+    return sorted(i for i in set(full_lines) if 0 < i < len(code) - 2)
+
+@dataclass
+class Language:
+    # minted (pygments) lexer name
+    lexer: str
+    extensions: List[str]
+    identifier: str = r'(?<!\w)[^\W\d]\w*'
+    line_comments: List[str] = field(default_factory=list)
+    # lookbehind a line comment start must match (ex. bash # only starts
+    # a comment at the start of a word)
+    line_comment_boundary: str = ''
+    block_comments: List[Tuple[str, str]] = field(default_factory=list)
+    # string delimiters, longest first (ex. ''' before ')
+    strings: List[str] = field(default_factory=lambda: ['"', "'"])
+    # string delimiters without escapes, spanning lines (ex. go `)
+    raw_strings: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.pattern = None
+        self.identifier_pattern = None
+
+    def get_pattern(self):
+        # NOTE compiled on first use so only languages that are
+        # actually listed pay for it
+        if self.pattern is None:
+            self.pattern = self.compile_pattern()
+
+        return self.pattern
+
+    def get_identifier_pattern(self):
+        if self.identifier_pattern is None:
+            self.identifier_pattern = re.compile(self.identifier)
+
+        return self.identifier_pattern
+
+    def compile_pattern(self):
+        # NOTE only comments and strings, identifiers are matched per
+        # line on the lines that carry tags
+        comments = [re.escape(start) + r'.*?(?:' + re.escape(end) + r'|\Z)'
+                    for start, end in self.block_comments]
+        comments += [self.line_comment_boundary + re.escape(start) +
+                     r'[^\n]*' for start in self.line_comments]
+
+        strings = [re.escape(delim) + r'.*?(?:' + re.escape(delim) + r'|\Z)'
+                   for delim in self.raw_strings]
+        for delim in self.strings:
+            d = re.escape(delim)
+            if len(delim) > 1:
+                strings.append(d + r'(?:\\.|.)*?(?:' + d + r'|\Z)')
+            else:
+                strings.append(
+                    d + r'(?:\\.|[^' + d + r'\\\n])*' + d)
+
+        groups = []
+        if comments:
+            groups.append('(?P<comment>{})'.format('|'.join(comments)))
+        if strings:
+            groups.append('(?P<string>{})'.format('|'.join(strings)))
+
+        if not groups:
+            return None
+
+        # NOTE runs that cannot start a comment or string are skipped in
+        # one match instead of trying every alternative at each character
+        starts = set(start[0] for start, _ in self.block_comments)
+        starts.update(start[0] for start in self.line_comments)
+        starts.update(delim[0] for delim in self.strings)
+        starts.update(delim[0] for delim in self.raw_strings)
+        groups.append('[^{}]+'.format(
+            ''.join(re.escape(start) for start in sorted(starts))))
+
+        return re.compile('|'.join(groups), re.DOTALL)
+
+LANGUAGES: Dict[str, Language] = dict()
+
+def register_language(language: Language):
+    for ext in language.extensions:
+        LANGUAGES[ext] = language
+
+def get_language(file_name) -> Optional[Language]:
+    return LANGUAGES.get(Path(file_name).suffix)
+
+C_COMMENTS = dict(line_comments=['//'], block_comments=[('/*', '*/')])
+# NOTE $ is part of identifiers in java and javascript (and gcc c)
+DOLLAR_IDENTIFIER = r'(?<![\w$])(?:[^\W\d]|\$)[\w$]*'
+
+register_language(Language('c', ['.c', '.h'],
+                           identifier=DOLLAR_IDENTIFIER, **C_COMMENTS))
+register_language(Language('c++', ['.cpp', '.hpp', '.cc', '.hh', '.cxx'],
+                           identifier=DOLLAR_IDENTIFIER, **C_COMMENTS))
+register_language(Language('java', ['.java'],
+                           identifier=DOLLAR_IDENTIFIER, **C_COMMENTS))
+register_language(Language('javascript', ['.js'],
+                           identifier=DOLLAR_IDENTIFIER, **C_COMMENTS))
+register_language(Language('go', ['.go'], raw_strings=['`'],
+                           **C_COMMENTS))
+register_language(Language('python', ['.py'], line_comments=['#'],
+                           strings=['"""', "'''", '"', "'"]))
+# NOTE shell function names may hold - . and :, # starts a comment
+# only at the start of a word (not in $# or ${#arr[@]})
+register_language(Language('bash', ['.sh'],
+                           identifier=r'(?<![\w.:-])[^\W\d][\w.:-]*',
+                           line_comments=['#'],
+                           line_comment_boundary=r'(?<![^\s;|&(])'))
+# NOTE lisp symbols are anything up to a delimiter (ex. 1+, my-fn)
+register_language(Language('common-lisp', ['.lisp', '.lsp', '.cl'],
+                           identifier=r'(?<![^\s(){}"\'`,;])'
+                                      r'[^\s(){}"\'`,;]+',
+                           line_comments=[';'],
+                           block_comments=[('#|', '|#')],
+                           strings=['"']))
 
 def sort_files_by_depth_and_order_key(a):
             c_a = a.count('/')
@@ -242,9 +420,9 @@ def sort_files_by_depth_and_order_key(a):
 def inline_pygmentize(file_name, code):
     wrapper = '\\mintinline[escapeinside=@@]{{{}}}{{{}}}'
 
-    ext = Path(file_name).suffix
-    if KNOWN_EXTS.get(ext):
-        return wrapper.format(KNOWN_EXTS[ext], code)
+    language = get_language(file_name)
+    if language:
+        return wrapper.format(language.lexer, code)
     else:
         return None
 
@@ -261,32 +439,168 @@ def pygmentize(file):
             """
 
             #print(file)
-            ext = Path(file).suffix
-            if KNOWN_EXTS.get(ext):
+            language = get_language(file)
+            if language:
                 return wrapper.format(
-                    KNOWN_EXTS[ext], code.read()).split('\n')
+                    language.lexer, code.read()).split('\n')
             else:
                 #print('NONE {}'.format(file))
                 return None
     except: # some file read error
         return None
 
-# computes at barriers with assumption they are not nested from the start
-# - this should keep them un-nested
-def at_barriers(text):
-    at_barriers = []
-
-    left_at = -1
-    for i, char in enumerate(text):
-        if char == '@' and left_at != -1:
-            at_barriers.append(set(range(left_at, i)))
-            left_at = -1
-        elif char == '@' and left_at == -1:
-            left_at = i
-        else:
-            pass
+@dataclass
+class Spans:
+    # buffer offsets of comments and strings, in order and not overlapping
+    starts: List[int]
+    ends: List[int]
+    # 'comment' or 'string'
+    kinds: List[str]
+    # buffer offset of each source line, line n starts at line_starts[n - 1]
+    line_starts: List[int]
+
+    def get_line(self, line_num, line_length):
+        # (start, end, kind) in line, clipped to the line
+        line_start = self.line_starts[line_num - 1]
+        line_end = line_start + line_length
+        spans = []
+        i = bisect_right(self.ends, line_start)
+        while i < len(self.starts) and self.starts[i] < line_end:
+            spans.append((max(self.starts[i], line_start) - line_start,
+                          min(self.ends[i], line_end) - line_start,
+                          self.kinds[i]))
+            i += 1
+
+        return spans
+
+@dataclass
+class SourceFile:
+    file_name: str
+    file_num: int
+    language: Language
+    # minted wrapped lines, source line n is code[n]
+    code: List[str]
+    # line number to (start index, identifier) in that line
+    identifiers: Dict[int, List[Tuple[int, str]]]
+    # comments and strings
+    spans: Spans
+    # line number to (index, latex) to be inserted in that line
+    links: Dict[int, List[Tuple[int, str]]] = field(default_factory=dict)
+
+    def find_identifier(self, line_num, name):
+        # NOTE first and last two lines are the minted wrapper
+        if not 0 < line_num < len(self.code) - 2:
+            return []
+
+        return [start for start, ident
+                in self.identifiers.get(line_num, [])
+                if ident == name]
+
+    def find_substring(self, line_num, name):
+        # NOTE for tag names the identifier rules cannot produce, only
+        # matches in code that are not a part of a longer identifier
+        if not 0 < line_num < len(self.code) - 2:
+            return []
+
+        line = self.code[line_num]
+        spans = self.spans.get_line(line_num, len(line))
+        identifiers = self.identifiers.get(line_num, [])
+        indices = []
+        index = line.find(name)
+        while index != -1:
+            end = index + len(name)
+            in_span = any(start < end and index < span_end
+                          for start, span_end, _ in spans)
+            in_identifier = any(
+                start < end and index < start + len(ident) and
+                (start < index or start + len(ident) > end)
+                for start, ident in identifiers)
+            if not in_span and not in_identifier:
+                indices.append(index)
+            index = line.find(name, index + 1)
+
+        return indices
+
+    def add_link(self, line_num, index, link):
+        self.links.setdefault(line_num, []).append((index, link))
+
+    def get_linked_code(self):
+        code = list(self.code)
+        # NOTE first and last two lines are the minted wrapper
+        escape_lines = [i for i in range(1, len(code) - 2) if '@' in code[i]]
+        for line_num in self.links.keys() | set(escape_lines):
+            line = code[line_num]
+            # (start, end, latex) replacing line[start:end], links are
+            # inserted so start == end
+            edits = [(index, index, link)
+                     for index, link in self.links.get(line_num, [])]
+
+            # NOTE only lines holding an @ have something to escape,
+            # strings are shown as is by minted so none there
+            if '@' in line:
+                strings = [(start, end) for start, end, kind
+                           in self.spans.get_line(line_num, len(line))
+                           if kind == 'string']
+                edits += [edit for edit in MINTED_ESCAPES.find(line)
+                          if not any(start <= edit[0] < end
+                                     for start, end in strings)]
+
+            pieces = []
+            prev_index = 0
+            # NOTE sort is stable so links at the same index keep the
+            # order they were added in and go before an escape there
+            for start, end, latex in sorted(edits, key=lambda x: x[0]):
+                pieces.append(line[prev_index:start])
+                pieces.append(latex)
+                prev_index = end
+            pieces.append(line[prev_index:])
+            code[line_num] = ''.join(pieces)
+
+        return code
+
+def tokenize(language, code, lines=None):
+    # NOTE comments and strings are matched over the whole file at once
+    # so the ones spanning lines are handled
+    body = '\n'.join(code[1:len(code) - 2])
+    line_starts = [0] + list(accumulate(
+        len(line) + 1 for line in code[1:len(code) - 3]))
+
+    # buffer spans of comments and strings, in order and not overlapping
+    span_starts = []
+    span_ends = []
+    span_kinds = []
+    pattern = language.get_pattern()
+    if pattern is not None:
+        for match in pattern.finditer(body):
+            if match.lastgroup is None:
+                continue
+
+            span_starts.append(match.start())
+            span_ends.append(match.end())
+            span_kinds.append(match.lastgroup)
+
+    # NOTE identifiers are only needed on the lines links go on
+    if lines is None:
+        lines = range(1, len(code) - 2)
+
+    identifiers = dict()
+    identifier_pattern = language.get_identifier_pattern()
+    for line_num in lines:
+        if not 0 < line_num < len(code) - 2:
+            continue
+
+        line_start = line_starts[line_num - 1]
+        for match in identifier_pattern.finditer(code[line_num]):
+            i = bisect_right(span_starts, line_start + match.start()) - 1
+            if i >= 0 and line_start + match.start() < span_ends[i]:
+                # inside of a comment or string
+                continue
+
+            identifiers.setdefault(line_num, []).append(
+                (match.start(), match.group()))
 
-    return at_barriers
+    return identifiers, Spans(span_starts, span_ends, span_kinds,
+                              line_starts)
 
 def uncompress(text, tagname):
     u_text = ''
@@ -325,16 +639,13 @@ def uncompress(text, tagname):
 
     return u_text
 
-def get_def_pages(gtags):
-    g_c = gtags.gtags_db.cursor()
+def get_def_pages(gtags, tagnames=None):
+    g_c = select_tags(gtags.gtags_db, tagnames)
     pages = dict()
 
-    g_c.execute('select * from db')
     tag = g_c.fetchone()
 
-    # file number to name
-    file_transformer = dict([reversed(f)
-                             for f in gtags.get_files()])
+    file_transformer = gtags.get_file_names()
 
     while tag != None:
         # TODO fix for rev and fix issue with @{} in source code
@@ -376,15 +687,13 @@ def get_def_pages(gtags):
 
     return processed_pages
 
-def get_rev_pages(gtags):
-    gr_c = gtags.grtags_db.cursor()
+def get_rev_pages(gtags, tagnames=None):
+    gr_c = select_tags(gtags.grtags_db, tagnames)
     pages = dict()
 
-    gr_c.execute('select * from db')
     tag = gr_c.fetchone()
 
-    file_transformer = dict([reversed(f)
-                             for f in gtags.get_files()])
+    file_transformer = gtags.get_file_names()
 
     while tag != None:
         u_data = uncompress(tag['dat'], tag['key']) \
@@ -443,27 +752,25 @@ def parse_grtags_lines_list(text):
 
     return line_nums
 
-def process_reverse_links(gtags, file, code, def_pages):
-    file_num = file[1]
+def process_reverse_links(gtags, source, def_pages):
+    file_num = source.file_num
 
-    #print(('fn', file_num))
     gr_c = gtags.grtags_db.cursor()
     gr_c.execute('select * from db where extra=?',
                  [str(file_num)])
     rev_tags = gr_c.fetchall()
 
-    #print(rev_tags)
+    if isinstance(def_pages, LazyPages):
+        def_pages.load(tag['key'] for tag in rev_tags)
+
     for tag in rev_tags:
         tagname = tag['key']
 
-        if not def_pages.get(tagname):
-            #print('no def page: {}'.format(tagname))
+        page = def_pages.get(tagname)
+        if not page:
             continue
-        else:
-            pass
-            #print('def page: {}'.format(tagname))
 
-        link = def_pages[tagname].get_link()
+        link = page.get_link()
 
         u_data = uncompress(tag['dat'], tagname).split(' ')
         assert(file_num == int(u_data[0]))
@@ -471,164 +778,83 @@ def process_reverse_links(gtags, file, code, def_pages):
 
         line_nums = parse_grtags_lines_list(u_data[2])
 
-        #print(u_data[2])
-        #print(line_nums)
         for num in line_nums:
-            num_occurances = code[num].count(tagname)
-            assert(num_occurances > 0)
-
-            prev_index = 0
-            for _ in range(0, num_occurances):
-                # do not next @@ declarations
-                at_bars = at_barriers(code[num])
-
-                start_index = code[num] \
-                    .find(tagname, prev_index)
-                assert(start_index != -1)
-
-                # NOTE heuristic to play it safe and
-                # ignore potential partial matches (c-centric)
-
-                if start_index + len(tagname) < len(code[num]):
-                    test_char = code[num][start_index + len(tagname)]
-                    if test_char.isalnum() or test_char == '_':
-                        continue
-                elif start_index - 1 > 0:
-                    test_char = code[num][start_index - 1]
-                    if test_char.isalnum() or test_char == '_':
-                        continue
-                elif start_index + len(tagname) == len(code[num]):
-                    pass # safe b/c last
-                else: # be safe and continue (shouldn't happen)
-                    continue
-
-                #print(("At Bars", at_bars))
-                if any([(start_index in at_bar) for at_bar in at_bars]):
-                    continue
-
-                # XXX potential corruptions if code uses latex names for things
-                # - at some point should fix by aliasing used functions to
-                #   invalid names in most programming languages (if possible)
-
-                prev_index = start_index + len(tagname)
-
-                #print(code[num])
-                #print(code[num][:start_index + len(tagname)])
-                #print(code[num][start_index+len(tagname):])
-
-                code[num] = code[num][:start_index + len(tagname)] \
-                    + '@\\hyperlink{{{}}}{{$^D$}}@' \
-                         .format(link) \
-                    + code[num][start_index+len(tagname):]
-                #print(code[num])
-    return code
-
-def process_definitions(gtags, file, code, rev_pages, full_lines):
-    file_num = file[1]
+            # NOTE only whole identifiers outside of comments and
+            # strings are linked, using the language tokeniser
+            for start_index in source.find_identifier(num, tagname):
+                # XXX potential corruptions if code uses latex names for
+                # things - at some point should fix by aliasing used
+                # functions to invalid names in most programming
+                # languages (if possible)
+                source.add_link(
+                    num, start_index + len(tagname),
+                    '@\\hyperlink{{{}}}{{$^D$}}@'.format(link))
+
+    return source
+
+def process_definitions(gtags, source, rev_pages):
+    file_num = source.file_num
 
-    #print(('fn', file_num))
     g_c = gtags.gtags_db.cursor()
     g_c.execute('select * from db where extra=?',
                  [str(file_num)])
     def_tags = g_c.fetchall()
 
-    #print(def_tags)
+    if isinstance(rev_pages, LazyPages):
+        rev_pages.load(tag['key'] for tag in def_tags)
+
     for tag in def_tags:
         tagname = tag['key']
 
-        if not rev_pages.get(tagname):
-            #print('no rev page: {}'.format(tagname))
+        page = rev_pages.get(tagname)
+        if not page:
             continue
-        else:
-            pass
-            #print('rev page: {}'.format(tagname))
 
-        link = rev_pages[tagname].get_link()
+        link = page.get_link()
 
         u_data = uncompress(tag['dat'], tag['key']) \
             .split(' ', maxsplit=3)
-        #print(u_data)
 
         if len(u_data) != 4 or not u_data[0].isnumeric():
             continue
 
-        file_num = int(u_data[0])
         tagname = u_data[1].strip()
         assert(tagname == tag['key'].strip())
         line_num = int(u_data[2])
-        definition = u_data[3]
-
-        # NOTE heuristic to go with leftmost match and veto others
-        count = code[line_num].count(tagname)
-        valid_index = -1
-        if count > 1:
-            prev_index = 0
-            for i in range(0, count):
-                current_index = code[line_num].find(tagname, prev_index)
-                # would be better to make this a per
-                # language thing (specifically for languages
-                # which use hyphens in variables names)
-                if current_index + len(tagname) < len(code[line_num]):
-                    #print('test after')
-                    test_char = code[line_num][current_index + len(tagname)]
-                    # this is c-centric for now
-                    # - not lisp centric
-                    if test_char.isalnum() or test_char == '_':
-                        pass
-                    elif current_index - 1 > 0:
-                        #print('test before')
-                        test_char = code[line_num][current_index - 1]
-                        if test_char.isalnum() or test_char == '_':
-                            pass
-                        else:
-                            valid_index = current_index
-                            break
-                    else: # no characters before
-                        valid_index = current_index
-                        break
-                # end of line name is valid
-                elif current_index + len(tagname) == len(code[line_num]):
-                    valid_index = current_index
-
-                prev_index = current_index + len(tagname)
-        else:
-            valid_index = code[line_num].find(tagname)
 
-        if valid_index == -1:
-            #print(code[line_num])
+        # NOTE go with leftmost match and veto others
+        start_indices = source.find_identifier(line_num, tagname)
+        if not start_indices:
+            # the language rules cannot produce this tag name, fall back
+            # to the leftmost match in code on identifier boundaries
+            start_indices = source.find_substring(line_num, tagname)
+        if not start_indices:
+            if 0 < line_num < len(source.code) - 2 and \
+                    tagname in source.code[line_num]:
+                # only found inside of comments, strings or longer names
+                continue
             raise Exception('Heuristic failure: check language details')
 
-        start_index = code[line_num] \
-            .find(tagname, valid_index)
-
-        # do not next @@ declarations
-        at_bars = at_barriers(code[line_num])
-        if any([(start_index in at_bar) for at_bar in at_bars]):
-            continue
-
-        #print(code[line_num])
-        assert(start_index != -1)
+        source.add_link(
+            line_num, start_indices[0] + len(tagname),
+            '@\\hyperlink{{{}}}{{$^R$}}@'.format(link))
 
-        prev_index = start_index + 1
+    return source
 
-        code[line_num] = code[line_num][:start_index + len(tagname)] \
-            + '@\\hyperlink{{{}}}{{$^R$}}@' \
-                    .format(link) \
-            + code[line_num][start_index+len(tagname):]
-        #print(code[line_num])
-
-    return code
-
-def get_full_lines(gtags):
+def get_full_lines(gtags, file_nums=None):
     gr_c = gtags.grtags_db.cursor()
     g_c = gtags.gtags_db.cursor()
 
     per_file_full_lines = dict()
 
-    gr_c.execute('select * from db')
-    rev_tags = gr_c.fetchall()
-    g_c.execute('select * from db')
-    def_tags = g_c.fetchall()
+    if file_nums is None:
+        gr_c.execute('select * from db')
+        rev_tags = gr_c.fetchall()
+        g_c.execute('select * from db')
+        def_tags = g_c.fetchall()
+    else:
+        rev_tags = select_file_tags(gtags.grtags_db, file_nums)
+        def_tags = select_file_tags(gtags.gtags_db, file_nums)
 
     for tag in rev_tags:
         tag = tag['dat']
@@ -660,42 +886,203 @@ def get_full_lines(gtags):
 
     return per_file_full_lines
 
-def latex_escape(text):
-    text = text.replace('_', '\\_')
-    return text
-
-def code_snippet_fix_brackets(code, brackets):
-    # TODO come up with better scheme
-    left_b_original = brackets[0][0]
-    left_b_replacement = brackets[0][1]
-    right_b_original = brackets[1][0]
-    right_b_replacement = brackets[1][1]
-
-    code = code.replace(left_b_original, left_b_replacement)
-    code = code.replace(right_b_original, right_b_replacement)
-
-    return code
-
-@click.command()
-@click.option('--use-rev', default=False)
-def main(use_rev):
-    gtags = Gtags()
-
-    files = gtags.get_files()
-    def_pages = get_def_pages(gtags)
-    rev_pages = get_rev_pages(gtags)
-
-    full_lines = get_full_lines(gtags)
-
-    all_codes = []
-    for file in files:
-        file_name, code = process_file(gtags, file, def_pages, rev_pages, full_lines, use_rev)
+# NOTE every escape is one pass over a character table, a regex over
+# the characters is much faster than str.translate with multi-character
+# replacements (see benchmarks/escape.py)
+# - minted: pygments already escapes the LaTeX specials of the source
+#   itself (\PYGZbs{}, \PYGZdl{}, \PYGZus{}, ...) in code, comments and
+#   strings, the one character it leaves is the escapeinside delimiter,
+#   honoured in code and comments but not in strings so those are skipped
+#   (see SourceFile.get_linked_code)
+# - mintinline: the same and the snippet braces must stay balanced
+# - text outside of minted (titles, file names): all LaTeX specials
+@dataclass
+class Escapes:
+    table: Dict[str, str]
+
+    def __post_init__(self):
+        self.pattern = re.compile('[{}]'.format(
+            ''.join(re.escape(char) for char in self.table)))
+
+    def escape(self, text):
+        return self.pattern.sub(lambda match: self.table[match.group()],
+                                text)
+
+    def find(self, text):
+        return [(match.start(), match.end(), self.table[match.group()])
+                for match in self.pattern.finditer(text)]
+
+MINTED_ESCAPES = Escapes({
+    '@': '@\\PYGZat{}@',
+})
+
+MINTINLINE_ESCAPES = Escapes({
+    '@': '@\\PYGZat{}@',
+    '{': '@$\\lbrace$@',
+    '}': '@$\\rbrace$@',
+})
+
+LATEX_TEXT_ESCAPES = Escapes({
+    '\\': '\\textbackslash{}',
+    '{': '\\{',
+    '}': '\\}',
+    '_': '\\_',
+    '$': '\\$',
+    '&': '\\&',
+    '#': '\\#',
+    '%': '\\%',
+    '~': '\\textasciitilde{}',
+    '^': '\\textasciicircum{}',
+})
 
-        if file_name is None or code is None:
-            pass
+def latex_escape(text):
+    return LATEX_TEXT_ESCAPES.escape(text)
+
+class Checkpoint:
+    """Per-file fragments and failures persisted as a run progresses."""
+
+    def __init__(self, path, options, database, resume=False):
+        self.path = Path(path)
+        self.fragments_path = self.path / 'fragments'
+        self.failures_path = self.path / 'failures'
+        self.manifest_path = self.path / 'manifest.json'
+        self.database = database
+
+        if resume and self.manifest_path.exists():
+            manifest = read_json(self.manifest_path)
+            prev_options = manifest['options']
+            if prev_options != options:
+                raise click.UsageError(
+                    'checkpoint {} was made with options {}, not {}'
+                    .format(self.path, prev_options, options))
+            # line numbers and file numbers of the fragments belong to
+            # the database they were made from
+            if manifest.get('database') != database:
+                raise click.UsageError(
+                    'checkpoint {} was made from another GNU Global '
+                    'database, rerun without --resume'.format(self.path))
         else:
-            all_codes.append((file_name, code))
-
+            for old in self.fragments_path.glob('*.json'):
+                old.unlink()
+            for old in self.failures_path.glob('*.json'):
+                old.unlink()
+
+        self.fragments_path.mkdir(parents=True, exist_ok=True)
+        self.failures_path.mkdir(parents=True, exist_ok=True)
+        write_json(self.manifest_path,
+                   {'options': options, 'database': database})
+
+    def is_done(self, file):
+        return (self.fragments_path / '{}.json'.format(file[1])).exists()
+
+    def save_fragment(self, file, code, targets):
+        write_json(self.fragments_path / '{}.json'.format(file[1]),
+                   {'file_name': file[0], 'file_num': file[1],
+                    'code': code, 'targets': targets})
+
+        # retried successfully after a previous failure
+        failure = self.failures_path / '{}.json'.format(file[1])
+        if failure.exists():
+            failure.unlink()
+
+    def save_failure(self, file, error):
+        write_json(self.failures_path / '{}.json'.format(file[1]),
+                   {'file_name': file[0], 'file_num': file[1],
+                    'error': error})
+
+    def save_shard_manifest(self, options, shard, files):
+        targets = []
+        for fragment in read_fragments(self.path):
+            targets += fragment['targets']
+
+        write_json(self.manifest_path, {
+            'options': options,
+            'database': self.database,
+            'shard': shard,
+            'files': [file[1] for file in files],
+            'failures': [failure['file_name']
+                         for failure in read_failures(self.path)],
+            'targets': sorted(targets),
+        })
+
+def get_database_fingerprint():
+    # NOTE hash of the contents rather than modification times so
+    # shards run on copies of the database still line up
+    fingerprint = dict()
+    for name in ('GPATH', 'GTAGS', 'GRTAGS'):
+        try:
+            with open(name, 'rb') as db:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: db.read(1 << 20), b''):
+                    digest.update(chunk)
+            fingerprint[name] = digest.hexdigest()
+        except FileNotFoundError:
+            fingerprint[name] = None
+
+    return fingerprint
+
+def read_json(path):
+    with open(path) as data:
+        return json.load(data)
+
+def read_fragments(path):
+    return [read_json(fragment)
+            for fragment in (Path(path) / 'fragments').glob('*.json')]
+
+def read_failures(path):
+    return [read_json(failure)
+            for failure in (Path(path) / 'failures').glob('*.json')]
+
+def get_fragment_codes(fragments):
+    # unrecognized extensions are stored without code
+    return [(fragment['file_name'], fragment['code'])
+            for fragment in fragments if fragment['code'] is not None]
+
+def parse_shard(text):
+    try:
+        k, n = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise click.BadParameter('expected K/N, ex. 1/4')
+
+    if not 1 <= k <= n:
+        raise click.BadParameter('K must be between 1 and N')
+
+    return k, n
+
+def is_included(file_name, path):
+    # path is already normalised
+    if path == '.':
+        return True
+
+    file_name = os.path.normpath(file_name)
+    return file_name == path or \
+        file_name.startswith(path.rstrip(os.sep) + os.sep)
+
+def get_listed_files(gtags, include):
+    # NOTE deterministic order so checkpoints and shards line up
+    # between runs
+    files = sorted(gtags.get_files(),
+                   key=lambda x: sort_files_by_depth_and_order_key(x[0]))
+    if include:
+        files = [file for file in files
+                 if any(is_included(file[0], path) for path in include)]
+
+    return files
+
+def get_shard_files(files, shard):
+    # NOTE contiguous ranges of the deterministic file order so a
+    # shard keeps directories together
+    k, n = shard
+    return files[(k - 1) * len(files) // n:k * len(files) // n]
+
+def write_json(path, data):
+    # NOTE write then rename so a killed run never leaves half a file
+    tmp_path = Path('{}.tmp'.format(path))
+    with open(tmp_path, 'w') as tmp:
+        json.dump(data, tmp)
+    os.replace(tmp_path, path)
+
+def write_document(all_codes, def_pages, rev_pages, use_rev):
     all_codes = sorted(all_codes, key=lambda x: x[0])
     all_codes = ['\\subsection{{\\texttt{{{}}}}}\n{}'
                  .format(
@@ -719,6 +1106,7 @@ def main(use_rev):
 
     with open('test.tex', 'w+') as test_out:
         output = '''\\documentclass{{article}}
+        \\usepackage[T1]{{fontenc}}
         \\usepackage{{fontawesome}}
         \\usepackage{{minted}}
         \\usepackage{{hyperref}}
@@ -745,6 +1133,234 @@ def main(use_rev):
         )
         test_out.write(output)
 
+@click.group(invoke_without_command=True)
+@click.option('--use-rev', default=False)
+@click.option('--checkpoint-dir', default=None,
+              help='Persist per-file fragments and failures here.')
+@click.option('--resume', is_flag=True,
+              help='Skip files already completed in --checkpoint-dir.')
+@click.option('--shard', default=None,
+              help='Only process part K of N of the files (ex. 1/4), '
+                   'see the merge command.')
+@click.option('--include', multiple=True,
+              help='Only list this file or directory, may be repeated.')
+@click.pass_context
+def main(ctx, use_rev, checkpoint_dir, resume, shard, include):
+    if ctx.invoked_subcommand is not None:
+        # NOTE merge takes these from the shard manifests, rather than
+        # silently ignoring them
+        given = [param.opts[0] for param in ctx.command.params
+                 if ctx.params.get(param.name) not in (None, False, ())]
+        if given:
+            raise click.UsageError('{} cannot be used with {}'.format(
+                ', '.join(given), ctx.invoked_subcommand))
+        return
+
+    if resume and checkpoint_dir is None:
+        raise click.UsageError('--resume requires --checkpoint-dir')
+    if shard is not None and checkpoint_dir is None:
+        raise click.UsageError('--shard requires --checkpoint-dir')
+
+    # NOTE gtags writes GPATH keys as ./src/... so both sides are
+    # normalised before comparing
+    include = sorted(set(os.path.normpath(path) for path in include))
+
+    options = {'use_rev': bool(use_rev), 'include': include}
+    if shard is not None:
+        shard = parse_shard(shard)
+        options['shard'] = list(shard)
+
+    # NOTE validated before any pages are loaded so a mismatched
+    # --resume fails straight away
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = Checkpoint(checkpoint_dir, options,
+                                get_database_fingerprint(), resume)
+
+    gtags = Gtags()
+
+    files = get_listed_files(gtags, include)
+    if not files:
+        raise click.UsageError(
+            '--include {} matched no files in GPATH'
+            .format(' '.join(include)))
+    # NOTE an --include covering every file (ex. .) is a full listing
+    focused = len(files) < len(gtags.get_files())
+    if shard is not None:
+        files = get_shard_files(files, shard)
+
+    # NOTE focused listings and shards only look up the tags and lines
+    # of their own files, full listings need every page anyway
+    # - without an index on key every lookup scans the table, so shards
+    #   (many files) then load all pages in one pass instead
+    def get_pages(db, get_all_pages):
+        if focused or (shard is not None and has_key_index(db)):
+            return LazyPages(gtags, get_all_pages)
+        return get_all_pages(gtags)
+
+    def_pages = get_pages(gtags.gtags_db, get_def_pages)
+    rev_pages = None
+    if use_rev:
+        rev_pages = get_pages(gtags.grtags_db, get_rev_pages)
+
+    if focused or shard is not None:
+        full_lines = get_full_lines(gtags, [file[1] for file in files])
+    else:
+        full_lines = get_full_lines(gtags)
+
+    all_codes = []
+    all_file_nums = []
+    failures = []
+    for file in files:
+        if checkpoint is not None and checkpoint.is_done(file):
+            continue
+
+        try:
+            file_name, code = process_file(gtags, file, def_pages, rev_pages, full_lines, use_rev)
+        except Exception as e:
+            # record and carry on rather than losing the whole run
+            failures.append(file)
+            if checkpoint is not None:
+                checkpoint.save_failure(file, repr(e))
+            click.echo('failed {}: {!r}'.format(file[0], e), err=True)
+            continue
+
+        if checkpoint is not None:
+            targets = []
+            if code is not None:
+                targets = [src_get_line_link(file[1], i)
+                           for i in get_target_lines(
+                               code, full_lines.get(file[1], ()))]
+            checkpoint.save_fragment(file, code, targets)
+        elif file_name is None or code is None:
+            pass
+        else:
+            all_codes.append((file_name, code))
+            all_file_nums.append(file[1])
+
+    if failures:
+        click.echo('{} file(s) failed and were left out'
+                   .format(len(failures)), err=True)
+
+    if shard is not None:
+        # the document is written by merge once all shards are done
+        checkpoint.save_shard_manifest(options, shard, files)
+    else:
+        if checkpoint is not None:
+            fragments = read_fragments(checkpoint.path)
+            all_codes = get_fragment_codes(fragments)
+            all_file_nums = [fragment['file_num'] for fragment in fragments
+                             if fragment['code'] is not None]
+
+        # NOTE lazy pages only hold the tags looked up in this run, the
+        # pages of every tag referenced or defined in the listed files
+        # are written as a full listing would (fragments resumed from a
+        # checkpoint included)
+        if focused:
+            tagnames = set(tag['key'] for tag in select_file_tags(
+                gtags.grtags_db, all_file_nums))
+            tagnames.update(tag['key'] for tag in select_file_tags(
+                gtags.gtags_db, all_file_nums))
+            def_pages.load(tagnames)
+            if use_rev:
+                rev_pages.load(tagnames)
+
+        write_document(all_codes, def_pages, rev_pages, use_rev)
+
+    gtags.gpath_db.close()
+    gtags.gtags_db.close()
+    gtags.grtags_db.close()
+
+@main.command()
+@click.argument('shard_dirs', nargs=-1, required=True)
+def merge(shard_dirs):
+    """Stitch the checkpoint directories of --shard runs together."""
+    manifests = []
+    for shard_dir in shard_dirs:
+        manifest = read_json(Path(shard_dir) / 'manifest.json')
+        if 'shard' not in manifest:
+            raise click.UsageError(
+                '{} is not the output of a --shard run'.format(shard_dir))
+        manifests.append(manifest)
+
+    def get_run_options(manifest):
+        return {key: value for key, value in manifest['options'].items()
+                if key != 'shard'}
+
+    use_rev = manifests[0]['options']['use_rev']
+    n = manifests[0]['shard'][1]
+    options = get_run_options(manifests[0])
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        if get_run_options(manifest) != options:
+            raise click.UsageError(
+                '{} was made with different options'.format(shard_dir))
+
+    # the pages are built from the database in the current directory
+    database = get_database_fingerprint()
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        if manifest.get('database') != database:
+            raise click.UsageError(
+                '{} was made from another GNU Global database'
+                .format(shard_dir))
+
+    shards = sorted(manifest['shard'][0] for manifest in manifests)
+    if [m['shard'][1] for m in manifests] != [n] * len(manifests) or \
+            shards != list(range(1, n + 1)):
+        raise click.UsageError(
+            'expected shards 1 to {} of {} once each, got {}'
+            .format(n, n, shards))
+
+    gtags = Gtags()
+
+    # NOTE each file in exactly one shard, out of the same list of files
+    # the shard runs split
+    file_names = gtags.get_file_names()
+    def get_names(file_nums):
+        return ', '.join(file_names.get(num, str(num))
+                         for num in sorted(file_nums)[:5])
+
+    file_nums = set()
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        duplicates = file_nums.intersection(manifest['files'])
+        if duplicates:
+            raise click.UsageError(
+                '{} lists files of another shard: {}'.format(
+                    shard_dir, get_names(duplicates)))
+        file_nums.update(manifest['files'])
+
+    listed = set(file[1] for file in
+                 get_listed_files(gtags, options.get('include', [])))
+    if file_nums != listed:
+        raise click.UsageError(
+            'shards do not match the files in GPATH, missing: {}, '
+            'unknown: {}'.format(get_names(listed - file_nums) or '-',
+                                 get_names(file_nums - listed) or '-'))
+
+    # overlapping shards would define the same hypertarget twice
+    targets = set()
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        duplicates = targets.intersection(manifest['targets'])
+        if duplicates:
+            raise click.UsageError(
+                '{} redefines link targets {}'.format(
+                    shard_dir, sorted(duplicates)[:5]))
+        targets.update(manifest['targets'])
+
+        for failure in manifest['failures']:
+            click.echo('failed in {}: {}'.format(shard_dir, failure),
+                       err=True)
+
+    all_codes = []
+    for shard_dir in shard_dirs:
+        all_codes += get_fragment_codes(read_fragments(shard_dir))
+
+    def_pages = get_def_pages(gtags)
+    rev_pages = None
+    if use_rev:
+        rev_pages = get_rev_pages(gtags)
+
+    write_document(all_codes, def_pages, rev_pages, use_rev)
+
     gtags.gpath_db.close()
     gtags.gtags_db.close()
     gtags.grtags_db.close()